@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark the JSON codecs on a synthetic people table.
+
+Usage:
+  json_codec.py [options]
+  json_codec.py (--help | --version)
+
+Options:
+  -h, --help           Print this message and exit.
+  --people=<n>         Number of people in the synthetic table [default: 20000].
+  --rounds=<n>         Number of rounds per measurement, the best one is reported [default: 5].
+  --version            Print version info and exit.
+"""
+
+import datetime
+import docopt
+import random
+import timeit
+
+import people
+
+# floats are formatted differently by some JSON libraries, and NaN and infinity aren't valid JSON
+FLOAT_SAMPLES = {
+    'people': {
+        'floats': {
+            'small': 1e-07,
+            'large': 1e+16,
+            'normal': [0.1, 1.5, -2.25, 123456.789],
+            'nan': float('nan'),
+            'infinity': [float('inf'), float('-inf')],
+        },
+    },
+    'version': 3,
+}
+
+def synthetic_people(count):
+    rng = random.Random(count)
+    date = datetime.datetime(2012, 1, 1, tzinfo=datetime.timezone.utc)
+    result = {}
+    for i in range(count):
+        wmbid = 'person{}'.format(i)
+        date += datetime.timedelta(hours=rng.randrange(1, 48))
+        result[wmbid] = {
+            'name': 'Pörson Nümber {}'.format(i),
+            'description': 'A description of person {} with some text in it. '.format(i) * rng.randrange(1, 5),
+            'favColor': {'red': rng.randrange(256), 'green': rng.randrange(256), 'blue': rng.randrange(256)},
+            'minecraft': {
+                'nicks': ['nick{}_{}'.format(i, j) for j in range(rng.randrange(1, 4))],
+                'uuid': '{:032x}'.format(rng.getrandbits(128)),
+            },
+            'options': {'show_inventory': rng.random() < 0.5, 'activity_tweets': rng.random() < 0.5},
+            'statusHistory': [
+                {'by': 'person0', 'date': date.isoformat(), 'status': 'invited'},
+                {'by': 'person0', 'date': (date + datetime.timedelta(days=7)).isoformat(), 'status': 'later'},
+            ],
+        }
+    return {'version': 3, 'people': result}
+
+def best_of(func, rounds):
+    return min(timeit.repeat(func, number=1, repeat=rounds))
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__, version='people JSON codec benchmark ' + people.people.__version__)
+    rounds = int(arguments['--rounds'])
+    obj = synthetic_people(int(arguments['--people']))
+    rows = list(obj['people'].values())
+    reference = people.JSONCodec()
+    reference_dump = reference.dumps(obj, pretty=True)
+    row_strings = [reference.dumps(row) for row in rows]
+    print('{} people, {} bytes pretty printed'.format(len(rows), len(reference_dump)))
+    for name in sorted(people.people.JSON_CODECS):
+        try:
+            codec = people.get_json_codec(name)
+        except ValueError as e:
+            print('{}: skipped ({})'.format(name, e))
+            continue
+        if codec.dumps(obj, pretty=True) != reference_dump:
+            print('{}: pretty output differs from the stdlib codec!'.format(name))
+        if codec.dumps(obj) != reference.dumps(obj):
+            print('{}: compact output differs from the stdlib codec!'.format(name))
+        if codec.dumps(FLOAT_SAMPLES, pretty=True) != reference.dumps(FLOAT_SAMPLES, pretty=True):
+            print('{}: pretty output with floats differs from the stdlib codec!'.format(name))
+        if codec.dumps(FLOAT_SAMPLES) != reference.dumps(FLOAT_SAMPLES):
+            print('{}: compact output with floats differs from the stdlib codec!'.format(name))
+        # the exact formatting of query parameters may differ, their values may not
+        if reference.dumps(reference.loads(codec.dumps_db(FLOAT_SAMPLES))) != reference.dumps(FLOAT_SAMPLES):
+            print('{}: floats change when used as query parameters!'.format(name))
+        timings = [
+            ('dump', best_of(lambda: codec.dumps(obj, pretty=True), rounds)),
+            ('import', best_of(lambda: codec.loads(reference_dump), rounds)),
+            ('adapt rows', best_of(lambda: [codec.dumps_db(row) for row in rows], rounds)),
+            ('decode rows', best_of(lambda: [codec.loads(row) for row in row_strings], rounds)),
+        ]
+        print('{}: {}'.format(name, ', '.join('{} {:.3f}s'.format(path, seconds) for path, seconds in timings)))
@@ -1 +1 @@
-from .people import PeopleDB, PersonConverter, PeopleConverter, get_people_db
+from .people import PeopleDB, PersonConverter, PeopleConverter, JSONCodec, OrjsonCodec, get_json_codec, get_people_db
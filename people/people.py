@@ -13,6 +13,10 @@ Usage:
   people [options] list
   people [options] add <name> <status>
   people [options] status <name> <status> [<reason>]
+  people [options] members [--status=<status>]...
+  people [options] tokens <names>...
+  people [options] expiretokens
+  people [options] migrate
   people (--help | --version)
 
 Options:
@@ -24,26 +28,43 @@ Options:
   --format=<format>  The people.json format version (3 default, 2 will convert)
   --by=<name>        The user who wants to perform the status change, defaults to shell username if allowed
   -r, --raw          Interpret the <value> parameter for setkey as a raw string. [default: false]
+  -j, --jobs=<jobs>  Number of processes validating people for import, defaults to the number of CPUs
+  --at=<date>        The date for members, defaults to now. Dates without a time mean midnight UTC.
+  --status=<status>  Only list members with this status at the given date, can be given multiple times
+  --min-days=<days>  Only list members who have had their status for at least this many days
+  --lifetime=<days>  Number of days until generated tokens expire, 0 for never [default: 7]
 """
 
 # This script requires python3-psycopg2 and dpath
 
 import sys
 
+import codecs
+import concurrent.futures
 import contextlib
+import copy
 import datetime
 import distutils.util
 import docopt
 import dpath.util
 import iso8601
+import itertools
 import json
 import jsonschema
+import math
 import os
 import pathlib
 import psycopg2
 import psycopg2.extras
+import random
 import re
 import uuid
+import warnings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 __version__ = '0.1'
 DEFAULT_CONFIG = {
@@ -53,6 +74,12 @@ DEFAULT_CONFIGFILE = "/opt/wurstmineberg/config/database.json"
 
 WMBID_REGEX = '^[a-z][a-z0-9]{1,15}$'
 
+DEFAULT_TOKEN_LIFETIME = datetime.timedelta(days=7)
+
+# Validating a person takes about 0.2ms, while a process pool costs about 40ms to start (including building the
+# validator in each worker) plus pickling. Below this many people validating in the current process is faster.
+PARALLEL_MIN_PEOPLE = 1000
+
 file_abspath = os.path.abspath(__file__)
 while os.path.islink(file_abspath):
     file_abspath = os.readlink(file_abspath)
@@ -66,32 +93,238 @@ with open(os.path.join(package_dir, "schemas", "people_schema_v3.json"), "r") as
 
 SCHEMA_RESOLVER = jsonschema.RefResolver('file://' + package_dir + '/schemas/', None)
 
+psycopg2.extensions.register_adapter(dict, psycopg2.extras.Json)
+
+_validators = {}
+
+def validate_schema(obj, schema):
+    # jsonschema.validate checks the schema itself on every call, which takes much longer than validating a person
+    if id(schema) not in _validators or _validators[id(schema)][0] is not schema:
+        validator_class = jsonschema.validators.validator_for(schema)
+        validator_class.check_schema(schema)
+        _validators[id(schema)] = schema, validator_class(schema, format_checker=jsonschema.FormatChecker(), resolver=SCHEMA_RESOLVER)
+    error = jsonschema.exceptions.best_match(_validators[id(schema)][1].iter_errors(obj))
+    if error is not None:
+        return (False, error)
+    return (True, None)
+
+def _validate_person(item):
+    """Validates a (uid, v3 person) pair, returns the error message or None. Runs in the process pool."""
+    uid, person = item
+    valid, error = validate_schema(person, VERSION_3_PERSON_OBJECT_SCHEMA)
+    if not valid:
+        return "Person '{}' is not valid at '{}': {}".format(uid, '.'.join(str(part) for part in error.absolute_path), error.message)
+
+def _map_chunk(args):
+    """Applies a function to a (function, list of items) chunk. Runs in the process pool."""
+    func, chunk = args
+    return [func(item) for item in chunk]
+
+class JSONCodec:
+    """The stdlib JSON codec. Also the fallback if no faster JSON library is installed."""
+    name = 'json'
+
+    def dumps(self, obj, pretty=False):
+        if pretty:
+            return json.dumps(obj, sort_keys=True, indent=4)
+        else:
+            return json.dumps(obj)
+
+    def dumps_db(self, obj):
+        """Serializes query parameters, unlike dumps the exact formatting may differ between codecs"""
+        return json.dumps(obj)
+
+    def loads(self, string):
+        return json.loads(string)
+
+def _json_escape_non_ascii(error):
+    """Codec error handler escaping characters like json.dumps does with ensure_ascii"""
+    escaped = []
+    for char in error.object[error.start:error.end]:
+        codepoint = ord(char)
+        if codepoint < 0x10000:
+            escaped.append('\\u{:04x}'.format(codepoint))
+        else:
+            codepoint -= 0x10000
+            escaped.append('\\u{:04x}\\u{:04x}'.format(0xd800 | (codepoint >> 10), 0xdc00 | (codepoint & 0x3ff)))
+    return ''.join(escaped), error.end
+
+codecs.register_error('people-json-escape', _json_escape_non_ascii)
+
+def _contains_float(obj, non_finite_only=False):
+    """Checks whether there are any floats (or only NaN and infinite ones) anywhere in obj"""
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        # fast paths for the common exact types before the isinstance checks
+        value_type = type(value)
+        if value_type is str:
+            continue
+        elif value_type is dict:
+            stack.extend(value.values())
+        elif value_type is list:
+            stack.extend(value)
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+        elif isinstance(value, float) and not (non_finite_only and math.isfinite(value)):
+            return True
+    return False
+
+class OrjsonCodec(JSONCodec):
+    """JSON codec using orjson. Output of dumps is identical to the stdlib codec: objects containing floats are
+    left to the stdlib, as orjson formats exponents differently and silently writes NaN and infinity as null.
+    Limitation: loads parses integers outside the 64 bit range as floats, losing precision. Checking for them costs
+    more than parsing with the stdlib, so if your data has such numbers set "json_codec" to "json" in the config."""
+    name = 'orjson'
+
+    def dumps(self, obj, pretty=False):
+        if not pretty or _contains_float(obj):
+            # the stdlib is fast enough without indentation and orjson can't do its separators and escaping
+            return super().dumps(obj, pretty=pretty)
+        try:
+            result = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2).decode('utf-8')
+        except orjson.JSONEncodeError:
+            # e.g. integers larger than 64 bit, let the stdlib deal with it
+            return super().dumps(obj, pretty=pretty)
+        # json.dumps escapes everything that isn't printable ASCII, orjson only control characters.
+        # Doing this first also makes the replacements below cheaper as they run on a pure ASCII string.
+        result = result.replace('\x7f', '\\u007f').encode('ascii', 'people-json-escape').decode('ascii')
+        # orjson can only indent by two spaces, json.dumps uses four. Raw newlines can't occur inside JSON strings
+        # so all spaces after a newline are indentation. Replace the deepest level first using NUL as a placeholder
+        # (orjson escapes control characters) so shallower levels don't match the start of deeper ones.
+        depth = 0
+        while '\n' + '  ' * (depth + 1) in result:
+            depth += 1
+        for level in range(depth, 0, -1):
+            result = result.replace('\n' + '  ' * level, '\n' + '\0' * level)
+        return result.replace('\0', '    ')
+
+    def dumps_db(self, obj):
+        try:
+            result = orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            return super().dumps_db(obj)
+        # The formatting of floats doesn't matter here, but NaN and infinity must not silently become null.
+        # The stdlib writes them as is, which the database rejects.
+        if b'null' in result and _contains_float(obj, non_finite_only=True):
+            return super().dumps_db(obj)
+        return result.decode('utf-8')
+
+    def loads(self, string):
+        try:
+            return orjson.loads(string)
+        except orjson.JSONDecodeError:
+            # the stdlib also accepts e.g. 1e400, NaN and Infinity
+            return super().loads(string)
+
+JSON_CODECS = {codec.name: codec for codec in [JSONCodec, OrjsonCodec]}
+
+def get_json_codec(name=None):
+    """Returns the JSON codec with the given name. Without a name the fastest installed codec is used."""
+    if name is None:
+        name = 'json' if orjson is None else 'orjson'
+    if name == 'orjson' and orjson is None:
+        raise ValueError("JSON codec 'orjson' requires the orjson package")
+    if name not in JSON_CODECS:
+        raise ValueError("Unknown JSON codec {!r}. Available codecs: {}".format(name, sorted(JSON_CODECS)))
+    return JSON_CODECS[name]()
+
 def transaction(func):
+    """Runs the function in a transaction on the primary. Marks the database as written to on success."""
     def func_wrapper(self, *args, **kwargs):
         if 'cur' in kwargs and kwargs['cur'] is not None:
             return func(self, *args, **kwargs)
         with self.conn:
             with self.conn.cursor() as cur:
+                result = func(self, *args, cur=cur, **kwargs)
+        self.written = True
+        return result
+    return func_wrapper
+
+def read_transaction(func):
+    """Runs the function in a transaction on a read replica if one is configured, otherwise on the primary."""
+    def func_wrapper(self, *args, **kwargs):
+        if 'cur' in kwargs and kwargs['cur'] is not None:
+            return func(self, *args, **kwargs)
+        conn = self.read_conn
+        with conn:
+            with conn.cursor() as cur:
                 return func(self, *args, cur=cur, **kwargs)
     return func_wrapper
 
 class PeopleDB:
-    def __init__(self, connectionstring, verbose=False):
+    def __init__(self, connectionstring, verbose=False, replica_connectionstrings=None, read_your_writes=True, codec=None, jobs=None):
+        """replica_connectionstrings can be a single connection string or a list of them. One of the replicas is
+        picked at random and used for read-only methods. If read_your_writes is set, all reads go to the primary
+        after the first write through this object, so the replication lag can't hide our own changes.
+        codec is the JSONCodec used for dumps, imports and the JSON(B) columns, defaults to the fastest installed one.
+        jobs is the number of processes used to validate people on import, defaults to the number of CPUs."""
+        self.codec = codec or get_json_codec()
         self.connectionstring = connectionstring
-        self.conn = psycopg2.connect(connectionstring)
-        psycopg2.extensions.register_adapter(dict, psycopg2.extras.Json)
+        self.conn = self.connect(connectionstring)
+        if isinstance(replica_connectionstrings, str):
+            replica_connectionstrings = [replica_connectionstrings]
+        self.replica_connectionstrings = list(replica_connectionstrings or [])
+        self.replica_conn = None
+        self.read_your_writes = read_your_writes
+        self.written = False
+        self.jobs = jobs or os.cpu_count() or 1
         self.verbose = verbose
 
+    @property
+    def read_conn(self):
+        if not self.replica_connectionstrings or (self.read_your_writes and self.written):
+            return self.conn
+        if self.replica_conn is None:
+            self.replica_conn = self.connect(random.choice(self.replica_connectionstrings))
+            self.replica_conn.set_session(readonly=True)
+        return self.replica_conn
+
+    def json_param(self, obj):
+        """Wraps obj for use as a query parameter, serialized with this database's codec"""
+        return psycopg2.extras.Json(obj, dumps=self.codec.dumps_db)
+
+    def connect(self, connectionstring):
+        conn = psycopg2.connect(connectionstring)
+        psycopg2.extras.register_default_json(conn, loads=self.codec.loads)
+        psycopg2.extras.register_default_jsonb(conn, loads=self.codec.loads)
+        return conn
+
     def disconnect(self):
         self.conn.close()
         self.conn = None
+        if self.replica_conn is not None:
+            self.replica_conn.close()
+            self.replica_conn = None
+
+    @contextlib.contextmanager
+    def person_map(self):
+        """Yields a map function that fans out over a process pool for large inputs. Results keep the input order.
+        The pool is only created by the first call that has enough items."""
+        executor = None
+
+        def pool_map(func, items):
+            nonlocal executor
+            items = list(items)
+            if self.jobs <= 1 or len(items) < PARALLEL_MIN_PEOPLE:
+                return map(func, items)
+            if executor is None:
+                executor = concurrent.futures.ProcessPoolExecutor(self.jobs)
+            # chunking ourselves as Executor.map only takes a chunksize since Python 3.5
+            size = max(1, len(items) // (self.jobs * 4))
+            chunks = [(func, items[i:i + size]) for i in range(0, len(items), size)]
+            return itertools.chain.from_iterable(executor.map(_map_chunk, chunks))
 
-    def validate_schema(self, person, schema):
         try:
-            jsonschema.validate(person, schema, format_checker=jsonschema.FormatChecker(), resolver=SCHEMA_RESOLVER)
-        except jsonschema.exceptions.ValidationError as e:
-            return (False, e)
-        return (True, None)
+            yield pool_map
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def validate_schema(self, person, schema):
+        return validate_schema(person, schema)
 
     def validate_person_schema(self, obj):
         return self.validate_schema(obj, VERSION_3_PERSON_OBJECT_SCHEMA)
@@ -99,7 +332,7 @@ class PeopleDB:
     def validate_obj_schema(self, obj):
         return self.validate_schema(obj, VERSION_3_SCHEMA)
 
-    @transaction
+    @read_transaction
     def obj_dump(self, cur=None, version=3):
         cur.execute("SELECT wmbid, snowflake, data, version FROM people")
         result = cur.fetchall()
@@ -118,48 +351,72 @@ class PeopleDB:
             peopleconv = PeopleConverter(obj)
             return peopleconv.get_version(version)
 
-    @transaction
     def obj_import(self, data, version=3, pretty=True, cur=None):
-        """This will import a dict in the database, dropping all previous data!"""
+        """This will import a dict in the database, dropping all previous data!
+        Everyone is converted and validated against the v3 person schema before the database is touched."""
+        if self.verbose:
+            print('Validating data...')
+        # The converters don't round-trip, so only the v3 conversion is validated and the input itself is stored
+        input_version = data.get('version', 2)
+        if input_version == 3:
+            v3_data = data
+        elif version == 3:
+            v3_data = PeopleConverter(data).get_version(3)
+        else:
+            # the v2 to v3 converter modifies its input, which is stored
+            v3_data = PeopleConverter(copy.deepcopy(data)).get_version(3)
+        with self.person_map() as mapper:
+            errors = [error for error in mapper(_validate_person, v3_data['people'].items()) if error is not None]
+        if errors:
+            raise ValueError("Schema is not valid! Errors:\n{}".format('\n'.join(errors)))
+        if version == 3:
+            data = v3_data
+        else:
+            data = PeopleConverter(data).get_version(version)
+        rows = []
+        for obj in data['people']:
+            if version <= 2:
+                rows.append((obj['id'], obj))
+            else:
+                rows.append((obj, data['people'][obj]))
+        return self.obj_import_rows(rows, version=version, cur=cur)
+
+    @transaction
+    def obj_import_rows(self, rows, version=3, cur=None):
+        """Replaces all people with the given (wmbid, data) rows. Doesn't validate anything, use obj_import for that."""
         # Delete all records
         if self.verbose:
             print('Deleting all records...')
         cur.execute("DELETE FROM people")
         if self.verbose:
             print('Importing data...')
-        converter = PeopleConverter(data)
-        data = converter.get_version(version)
-        for obj in data['people']:
-            if version <= 2:
-                items = obj
-                wmbid = obj['id']
-            else:
-                wmbid = obj
-                items = data['people'][obj]
-            cur.execute("INSERT INTO people (wmbid, data, version) VALUES (%s, %s, %s)", (wmbid, items, version))
+        for wmbid, items in rows:
+            cur.execute("INSERT INTO people (wmbid, data, version) VALUES (%s, %s, %s)", (wmbid, self.json_param(items), version))
         if self.verbose:
             print('Done!')
 
     def json_dump(self, version=3, pretty=True):
         obj = self.obj_dump(version=version)
-        if pretty:
-            return json.dumps(obj, sort_keys=True, indent=4)
-        else:
-            return json.dumps(obj)
+        return self.codec.dumps(obj, pretty=pretty)
 
     def json_import(self, string, version=3, pretty=True):
         """This will import a JSON string in the database, dropping all previous data!"""
-        data = json.loads(string)
+        data = self.codec.loads(string)
         return self.obj_import(data)
 
-    @transaction
+    @read_transaction
+    def person_exists(self, person, cur=None):
+        cur.execute("SELECT 1 FROM people WHERE wmbid = %s", (person,))
+        return cur.fetchone() is not None
+
+    @read_transaction
     def person_show(self, person, cur=None):
         cur.execute("SELECT data FROM people WHERE wmbid = %s", (person,))
         result = cur.fetchone()
         if result:
             return result[0]
 
-    @transaction
+    @read_transaction
     def person_get_key(self, person, key, cur=None):
         cur.execute("SELECT data FROM people WHERE wmbid = %s", (person,))
         result = cur.fetchone()
@@ -188,7 +445,7 @@ class PeopleDB:
             raise ValueError("Schema is not valid! Error: {}".format(error))
 
         # Update in database
-        cur.execute("UPDATE people SET data = %s WHERE wmbid=%s", (obj, person))
+        cur.execute("UPDATE people SET data = %s WHERE wmbid=%s", (self.json_param(obj), person))
 
     @transaction
     def person_set_key(self, person, key, data, cur=None):
@@ -208,6 +465,7 @@ class PeopleDB:
 
         return self.person_modify_data(person, _del_key)
 
+    @transaction
     def person_append_status(self, uid, status, by, date, reason=None, cur=None):
         allowed_statuses = ['disabled', 'former', 'founding', 'guest', 'invited', 'later']
         allowed_reasons = ['coc', 'guest', 'inactivity', 'request', 'vetoed']
@@ -223,16 +481,16 @@ class PeopleDB:
         if not date.tzinfo:
             date = date.replace(tzinfo=datetime.timezone.utc)
 
-        people = self.people_list()
-        if by not in people:
+        # check on the primary as a replica might not have the latest changes yet
+        if not self.person_exists(by, cur=cur):
             raise ValueError("Status update doesn't have a valid person associated. You must specify a valid wmbid.")
 
-        history = self.person_get_key(uid, 'statusHistory')
-        if len(history) > 0 and history[-1]['status'] == status:
-            raise ValueError("Status '{}' is the same as the previous status. The status must be different than before.".format(status))
-
         def _modify(uid, obj):
             nonlocal status, by, date, reason
+            # checked here on the locked row so no concurrent status change can slip in between
+            history = obj['statusHistory']
+            if len(history) > 0 and history[-1]['status'] == status:
+                raise ValueError("Status '{}' is the same as the previous status. The status must be different than before.".format(status))
             status_item = {
                 'by': by,
                 'status': status,
@@ -243,16 +501,16 @@ class PeopleDB:
             obj['statusHistory'].append(status_item)
             return obj
 
-        return self.person_modify_data(uid, _modify)
+        return self.person_modify_data(uid, _modify, cur=cur)
 
     @transaction
     def person_add_empty(self, uid, cur=None, version=3):
-        if uid in self.people_list():
+        if self.person_exists(uid, cur=cur):
             raise ValueError("Person {} already exists. Can't add.".format(uid))
         person = {
             "statusHistory": []
         }
-        cur.execute("INSERT INTO people (wmbid, data, version) VALUES (%s, %s, %s)", (uid, person, version))
+        cur.execute("INSERT INTO people (wmbid, data, version) VALUES (%s, %s, %s)", (uid, self.json_param(person), version))
 
     @transaction
     def person_delete(self, uid, cur=None):
@@ -277,23 +535,119 @@ class PeopleDB:
 
         return [wmb_id for wmb_id, person in sorted(self.obj_dump(version=3)['people'].items(), key=canonical_sort_key)]
 
+    @read_transaction
+    def people_with_status(self, at=None, statuses=None, min_duration=None, cur=None):
+        """Returns the IDs of everyone whose status at the given date is one of statuses, or any status if not given.
+        With min_duration only people who have had their status for at least that timedelta are returned.
+        The status history is evaluated in the database in list order. A status change without a date counts as
+        happening right after the previous dated one, or before everything else if there is none. People still
+        stored in format version 2 have no status history and are left out with a warning."""
+        if at is None:
+            at = datetime.datetime.now(datetime.timezone.utc)
+        elif not at.tzinfo:
+            at = at.replace(tzinfo=datetime.timezone.utc)
+        cur.execute("SELECT count(*) FROM people WHERE version <> 3")
+        old_count, = cur.fetchone()
+        if old_count:
+            warnings.warn('{} people are stored in format version 2 and are not included'.format(old_count))
+        conditions = []
+        params = {'at': at}
+        if statuses:
+            conditions.append("status = ANY(%(statuses)s)")
+            params['statuses'] = list(statuses)
+        if min_duration is not None:
+            conditions.append("since <= %(since)s")
+            params['since'] = at - min_duration
+        # Dates without a timezone (including those without time of day) are UTC, like iso8601.parse_date does it.
+        # The running maximum gives undated entries the date of the previous dated entry.
+        cur.execute("""
+            SELECT uid FROM (
+                SELECT DISTINCT ON (uid) uid, history.status, history.date AS since
+                FROM people
+                CROSS JOIN LATERAL (SELECT COALESCE(people.wmbid, people.snowflake::text) AS uid) AS ids
+                CROSS JOIN LATERAL (
+                    SELECT status, position, COALESCE(max(date) OVER (ORDER BY position), '-infinity') AS date
+                    FROM (
+                        SELECT item->>'status' AS status, position, CASE
+                            WHEN NOT item ? 'date' THEN NULL
+                            WHEN item->>'date' ~ '[0-9]{2}:[0-9]{2}(:[0-9]{2}(\\.[0-9]+)?)?([Zz]|[+-][0-9]{2}(:?[0-9]{2})?)$'
+                                THEN (item->>'date')::timestamptz
+                            ELSE (item->>'date')::timestamp AT TIME ZONE 'UTC'
+                        END AS date
+                        FROM jsonb_array_elements(people.data->'statusHistory') WITH ORDINALITY AS elements (item, position)
+                    ) AS entries
+                ) AS history
+                WHERE people.version = 3 AND history.date <= %(at)s
+                ORDER BY uid, history.position DESC
+            ) AS current_status
+        """ + ("WHERE " + " AND ".join(conditions) if conditions else "") + " ORDER BY uid", params)
+        return [uid for uid, in cur.fetchall()]
+
+    @transaction
+    def token_expiry_exists(self, cur=None):
+        """Checks whether the user_tokens table has the expires column added by create_token_schema"""
+        # not cached, a schema change in a transaction that is rolled back would leave the cache wrong
+        cur.execute("SELECT EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = 'user_tokens'::regclass AND attname = 'expires' AND NOT attisdropped)")
+        return cur.fetchone()[0]
+
+    @transaction
+    def create_token_schema(self, cur=None):
+        """Adds the expiry column and its index to the user_tokens table if they don't exist yet"""
+        # checking the catalog instead of using IF NOT EXISTS, which needs psql 9.6
+        if not self.token_expiry_exists(cur=cur):
+            cur.execute("ALTER TABLE user_tokens ADD COLUMN expires timestamp with time zone")
+        cur.execute("SELECT to_regclass('user_tokens_expires_idx') IS NULL")
+        if cur.fetchone()[0]:
+            cur.execute("CREATE INDEX user_tokens_expires_idx ON user_tokens (expires)")
+
     @transaction
-    def person_generate_token(self, uid, cur=None):
-        """Generates a one-time token for user registration. Invalidates old tokens"""
-        if uid in self.people_list():
-            cur.execute("DELETE FROM user_tokens WHERE wmbid = %s", (uid,))
-            token = str(uuid.uuid4())
-            cur.execute("INSERT INTO user_tokens (wmbid, token) VALUES (%s, %s)", (uid, token))
-            return token
+    def people_generate_tokens(self, uids, lifetime=DEFAULT_TOKEN_LIFETIME, cur=None):
+        """Generates one-time tokens for user registration for all given people at once. Invalidates their old tokens.
+        The tokens expire after the lifetime timedelta, or never if it is None. Returns a dict of tokens by ID.
+        Tokens with a lifetime need the expires column added by create_token_schema ('people migrate')."""
+        uids = list(dict.fromkeys(uids))
+        cur.execute("SELECT wmbid FROM people WHERE wmbid = ANY(%s)", (uids,))
+        existing = {wmbid for wmbid, in cur.fetchall()}
+        unknown = [uid for uid in uids if uid not in existing]
+        if unknown:
+            raise KeyError("Unkown people {}".format(', '.join(unknown)))
+        expiry_exists = self.token_expiry_exists(cur=cur)
+        if lifetime is not None and not expiry_exists:
+            raise ValueError("Tokens with an expiry need the expires column in user_tokens. Run 'people migrate' to add it.")
+        tokens = {uid: str(uuid.uuid4()) for uid in uids}
+        cur.execute("DELETE FROM user_tokens WHERE wmbid = ANY(%s)", (uids,))
+        if not expiry_exists:
+            # tokens without expiry also work on databases that haven't been migrated yet
+            psycopg2.extras.execute_values(cur, "INSERT INTO user_tokens (wmbid, token) VALUES %s", list(tokens.items()))
+            return tokens
+        if lifetime is None:
+            expires = None
         else:
-            raise KeyError("Unkown person {}".format(uid))
+            expires = datetime.datetime.now(datetime.timezone.utc) + lifetime
+        psycopg2.extras.execute_values(cur, "INSERT INTO user_tokens (wmbid, token, expires) VALUES %s",
+            [(uid, token, expires) for uid, token in tokens.items()])
+        return tokens
+
+    @transaction
+    def person_generate_token(self, uid, lifetime=None, cur=None):
+        """Generates a one-time token for user registration. Invalidates old tokens. The token doesn't expire unless
+        a lifetime timedelta is given."""
+        return self.people_generate_tokens([uid], lifetime=lifetime, cur=cur)[uid]
+
+    @transaction
+    def expire_tokens(self, cur=None):
+        """Deletes the one-time tokens that have expired. Returns the number of deleted tokens"""
+        if not self.token_expiry_exists(cur=cur):
+            # no tokens with an expiry have been generated yet
+            return 0
+        cur.execute("DELETE FROM user_tokens WHERE expires < now()")
+        return cur.rowcount
 
     @transaction
     def clear_tokens(self, cur=None):
         """Clears all one-time tokens from the database"""
         cur.execute("DELETE FROM user_tokens")
 
-
 class PeopleConverter:
     def __init__(self, obj):
         self.obj = obj
@@ -583,7 +937,10 @@ if __name__ != "__main__":
     CONFIG = get_config(DEFAULT_CONFIGFILE)
 
 def get_people_db(verbose=False):
-    db = PeopleDB(CONFIG['connectionstring'], verbose=verbose)
+    db = PeopleDB(CONFIG['connectionstring'], verbose=verbose,
+        replica_connectionstrings=CONFIG.get('replica_connectionstring'),
+        read_your_writes=CONFIG.get('read_your_writes', True),
+        codec=get_json_codec(CONFIG.get('json_codec')), jobs=CONFIG.get('jobs'))
     return db
 
 if __name__ == "__main__":
@@ -597,7 +954,11 @@ if __name__ == "__main__":
     if arguments['--force']:
         force = True
 
-    db = PeopleDB(CONFIG['connectionstring'], verbose=verbose)
+    db = PeopleDB(CONFIG['connectionstring'], verbose=verbose,
+        replica_connectionstrings=CONFIG.get('replica_connectionstring'),
+        read_your_writes=CONFIG.get('read_your_writes', True),
+        codec=get_json_codec(CONFIG.get('json_codec')),
+        jobs=int(arguments['--jobs']) if arguments['--jobs'] else CONFIG.get('jobs'))
 
     filename = None
     if '<filename>' in arguments:
@@ -630,7 +991,11 @@ if __name__ == "__main__":
             if not force and not prompt_yesno('Do you REALLY want to clear the database and import the file "{}"?'.format(filename)):
                 print('Not importing. Exiting.', file=sys.stderr)
                 exit(1)
-            db.json_import(data)
+            try:
+                db.json_import(data)
+            except ValueError as e:
+                print("Error: {}".format(e), file=sys.stderr)
+                exit(1)
 
     elif arguments['getkey']:
         try:
@@ -722,6 +1087,34 @@ if __name__ == "__main__":
             print("Error: {}".format(e), file=sys.stderr)
             exit(1)
 
+    elif arguments['members']:
+        at = None
+        if arguments['--at']:
+            at = iso8601.parse_date(arguments['--at'])
+        min_duration = None
+        if arguments['--min-days']:
+            min_duration = datetime.timedelta(days=int(arguments['--min-days']))
+        print(json.dumps(db.people_with_status(at=at, statuses=arguments['--status'], min_duration=min_duration)))
+
+    elif arguments['tokens']:
+        lifetime = None
+        if int(arguments['--lifetime']) > 0:
+            lifetime = datetime.timedelta(days=int(arguments['--lifetime']))
+        try:
+            tokens = db.people_generate_tokens(arguments['<names>'], lifetime=lifetime)
+        except (KeyError, ValueError) as e:
+            print("Error: {}".format(e.args[0]), file=sys.stderr)
+            exit(1)
+        print(json.dumps(tokens, sort_keys=True, indent=4))
+
+    elif arguments['expiretokens']:
+        count = db.expire_tokens()
+        if verbose:
+            print("Deleted {} expired tokens".format(count))
+
+    elif arguments['migrate']:
+        db.create_token_schema()
+
     elif arguments['validate']:
         data = db.obj_dump(version=format_version)
         valid, error = db.validate_obj_schema(data)
@@ -21,4 +21,7 @@ setuptools.setup(
         'passlib',
         'psycopg2',
     ],
+    extras_require={
+        'fast': ['orjson'],
+    },
 )